@@ -22,19 +22,28 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 ##
 
-import io
 import os
 import sys
 import enum
+import mmap
 import struct
 import click
+import numpy as np
 
 from pathlib import Path
+from collections.abc import Sequence
 from typing import Union, Tuple
 
 
 # All package types for the EFI_HII_PACKAGE_HEADER type field
-class HIIPackageTypes(enum.Enum):
+class HIIPackageTypes(enum.IntEnum):
+    # Keep the 'HIIPackageTypes.NAME' form when printed or formatted;
+    # before 3.11 IntEnum formats as a plain int otherwise
+    __str__ = enum.Enum.__str__
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
     TYPE_ALL = 0x00
     TYPE_GUID = 0x01
     FORMS = 0x02
@@ -70,138 +79,265 @@ class StringInfoBlockTypes(enum.Enum):
     FONT = 0x40
 
 
-EFI_HII_DATABASE_PROTOCOL_GUID = 'ef9fc172-a1b2-4693-b327-6d32fc416042'
-EFI_HII_EXPORT_DATABASE_GUID = '1b838190-4625-4ead-abc9-cd5e6af18fe0'
+def _member_table(enum_type) -> list:
+    # Raw byte -> enum member lookup, None for values outside the enum
+    table = [None] * 256
+    for member in enum_type:
+        table[member.value] = member
+    return table
+
+
+_HII_TYPE_TABLE = _member_table(HIIPackageTypes)
+_STRING_BLOCK_TYPE_TABLE = _member_table(StringInfoBlockTypes)
+
+# Interned, as are decoded package list GUIDs, so comparisons are cheap
+EFI_HII_DATABASE_PROTOCOL_GUID = sys.intern(
+    'ef9fc172-a1b2-4693-b327-6d32fc416042'
+)
+EFI_HII_EXPORT_DATABASE_GUID = sys.intern(
+    '1b838190-4625-4ead-abc9-cd5e6af18fe0'
+)
 EFI_VARS_ROOT = Path('/sys/firmware/efi/efivars')
 
+# Pre-compiled decoders for the fixed-size headers found in the database
+_HII_DESCRIPTOR = struct.Struct('@III')
+EFI_GUID = struct.Struct('=LHH8s')
+UINT32 = struct.Struct('=L')
+_HDR_DP = struct.Struct('=BBH')
+_HDR_STR = struct.Struct('=LL')
+_HDR_SF = struct.Struct('=HH')
+
+# Page-aligned chunk size used when writing buffers out to files
+_WRITE_CHUNK = 1 << 20
+
+# See section 32.3.2.2 -- EFI_NARROW_GLYPH and EFI_WIDE_GLYPH
+NARROW_GLYPH = np.dtype([('ch', '<u2'), ('attr', 'u1'), ('glyph', 'V19')])
+WIDE_GLYPH = np.dtype([
+    ('ch', '<u2'), ('attr', 'u1'), ('gl1', 'V19'), ('gl2', 'V19'), ('_pad', 'V3')
+])
+
+# Bytes following the type field of each fixed-size string information
+# block, indexed by raw block type; zero for everything else
+_STRING_BLOCK_SKIP = bytearray(256)
+for _block_type, _skip in (
+        (StringInfoBlockTypes.DUPLICATE, 2), (StringInfoBlockTypes.SKIP2, 2),
+        (StringInfoBlockTypes.SKIP1, 1), (StringInfoBlockTypes.EXT1, 1),
+        (StringInfoBlockTypes.EXT2, 2), (StringInfoBlockTypes.EXT4, 4)):
+    _STRING_BLOCK_SKIP[_block_type.value] = _skip
+_STRING_BLOCK_SKIP = bytes(_STRING_BLOCK_SKIP)
+del _block_type, _skip
+
 
 class HIIDBError(Exception):
     pass
 
 
-def read_hii_data() -> bytes:
+def read_hii_data() -> memoryview:
     if os.geteuid() != 0:
         raise HIIDBError('Reading the HII database requires root access')
     data_path = EFI_VARS_ROOT / 'HiiDB-{}'.format(EFI_HII_DATABASE_PROTOCOL_GUID)
     if not data_path.exists() or data_path.stat().st_size != 12:
         raise HIIDBError('HII DB export missing, cannot continue')
-    with open(data_path, 'rb') as hii_fd:
-        hii_descriptor = hii_fd.read(12)
+    data_fd = os.open(str(data_path), os.O_RDONLY)
+    try:
+        hii_descriptor = os.pread(data_fd, 12, 0)
+    finally:
+        os.close(data_fd)
     if len(hii_descriptor) != 12:
         raise HIIDBError('Unable to read the EFI HII descriptor variable')
-    hii_flags, hii_size, hii_addr = struct.unpack('@III', hii_descriptor)
-    with open('/dev/mem', 'rb') as devmem_fd:
-        devmem_fd.seek(hii_addr, os.SEEK_SET)
-        hii_database = devmem_fd.read(hii_size)
-    if len(hii_database) != hii_size:
+    hii_flags, hii_size, hii_addr = _HII_DESCRIPTOR.unpack(hii_descriptor)
+    # Map the database rather than copying it; the mapping must start on
+    # an allocation boundary, so trim the leading slack off the view.
+    map_slack = hii_addr % mmap.ALLOCATIONGRANULARITY
+    devmem_fd = os.open('/dev/mem', os.O_RDONLY)
+    try:
+        hii_map = mmap.mmap(
+            devmem_fd, hii_size + map_slack, prot=mmap.PROT_READ,
+            offset=hii_addr - map_slack
+        )
+    except (OSError, ValueError):
         raise HIIDBError('Unable to read HII database contents')
-    return hii_database
+    finally:
+        os.close(devmem_fd)
+    return memoryview(hii_map)[map_slack:map_slack + hii_size]
+
+
+def _write_buffer(path: str, buf: Union[bytes, memoryview]):
+    # Stream straight from the caller's buffer, bypassing Python's I/O
+    # buffering; os.write() may be partial, so track progress.
+    buf = memoryview(buf)
+    out_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        offset = 0
+        while offset < len(buf):
+            offset += os.write(out_fd, buf[offset:offset + _WRITE_CHUNK])
+    finally:
+        os.close(out_fd)
+
+
+class GlyphTable(Sequence):
+    __slots__ = ('_glyphs',)
+
+    def __init__(self, glyphs: np.ndarray):
+        """
+        Read-only view of a simple font glyph array.  Records are converted
+        to tuples only when they are accessed.
+        :param glyphs: An array of NARROW_GLYPH or WIDE_GLYPH records
+        """
+        self._glyphs = glyphs
+
+    def __len__(self) -> int:
+        return len(self._glyphs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return GlyphTable(self._glyphs[index])
+        glyph = self._glyphs[index]
+        if self._glyphs.dtype == NARROW_GLYPH:
+            return (
+                chr(glyph['ch']), int(glyph['attr']), glyph['glyph'].tobytes()
+            )
+        return (
+            chr(glyph['ch']), int(glyph['attr']),
+            glyph['gl1'].tobytes(), glyph['gl2'].tobytes()
+        )
+
+    # Compare, hash and print like the tuple of glyph tuples it replaces
+    def __eq__(self, other):
+        if isinstance(other, GlyphTable):
+            return tuple(self) == tuple(other)
+        if isinstance(other, tuple):
+            return tuple(self) == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return repr(tuple(self))
 
 
 class HIIPackage(object):
+    __slots__ = (
+        '_base', '_offset', '_size', '_raw_type', '_package_items'
+    )
 
-    def __init__(self, package_type: HIIPackageTypes, package_blob: bytes):
-        self._package_type = package_type
-        self._package_blob = package_blob
+    def __init__(self, base: memoryview, offset: int, size: int,
+                 raw_type: int):
+        """
+        Container and decoder for one HII package.
+        :param base: The HII database the package is stored in
+        :param offset: Offset of the package header within base
+        :param size: Size of the package, including its header
+        :param raw_type: The type field from the package header
+        """
+        self._base = base
+        self._offset = offset
+        self._size = size
+        self._raw_type = raw_type
         self._package_items = None
 
     @property
     def package_type(self) -> HIIPackageTypes:
-        return self._package_type
+        return _HII_TYPE_TABLE[self._raw_type]
+
+    @property
+    def blob(self) -> memoryview:
+        """
+        Return a zero-copy view of the serialized package.
+        """
+        return self._base[self._offset:self._offset + self._size]
 
     def _parse_device_paths(self):
         # See section 10.3.1 -- EFI_DEVICE_PATH_PROTOCOL
         package_items = []
-        package_fd = io.BytesIO(self._package_blob)
+        blob = self.blob
+        blob_len = len(blob)
         # type and length packed into an unsigned int
-        package_fd.seek(4, os.SEEK_SET)
-        while package_fd.tell() < len(self._package_blob):
-            if (package_fd.tell() + 4) > len(self._package_blob):
+        offset = 4
+        while offset < blob_len:
+            if (offset + 4) > blob_len:
                 raise HIIDBError('Insufficient data for device path header')
-            dp_header = struct.unpack('=BBH', package_fd.read(4))
+            dp_header = _HDR_DP.unpack_from(blob, offset)
+            offset += 4
             # Magic number: End of Hardware Device Path
             if dp_header[0] == 0x7F:
                 break
+            if dp_header[2] < 4:
+                raise HIIDBError('Invalid device path node length')
             body_len = dp_header[2] - 4
-            if (package_fd.tell() + body_len) > len(self._package_blob):
+            if (offset + body_len) > blob_len:
                 raise HIIDBError('Insufficient data for device path body')
-            dp_data = package_fd.read(body_len)
+            dp_data = blob[offset:offset + body_len].tobytes()
+            offset += body_len
             package_items.append(dp_header[:2] + (dp_data,))
-        if package_fd.tell() != len(self._package_blob):
+        if offset != blob_len:
             raise HIIDBError('Device path package could not be parsed')
         self._package_items = tuple(package_items)
 
     def _parse_strings(self):
-        header_size, string_info_offset = struct.unpack(
-            '=LL', self._package_blob[4:12]
-        )
-        assert header_size == string_info_offset
-        package_fd = io.BytesIO(self._package_blob)
-        package_fd.seek(header_size, os.SEEK_SET)
+        blob = self.blob
+        header_size, string_info_offset = _HDR_STR.unpack_from(blob, 4)
+        if header_size != string_info_offset:
+            raise HIIDBError('String package header size mismatch')
+        # bytes.find() gives a C-speed scan for string terminators
+        blob = blob.tobytes()
+        end_type = StringInfoBlockTypes.END.value
+        ucs2_type = StringInfoBlockTypes.STRING_UCS2.value
+        offset = header_size
         package_items = []
-        block_type = None
-        while block_type != StringInfoBlockTypes.END:
-            start_offset = package_fd.tell()
-            block_type = StringInfoBlockTypes(
-                struct.unpack('=B', package_fd.read(1))[0]
-            )
-            if block_type == StringInfoBlockTypes.STRING_UCS2:
-                while package_fd.read(2) != b'\x00\x00':
-                    pass
-            elif block_type == StringInfoBlockTypes.END:
-                pass
-            elif block_type == StringInfoBlockTypes.SKIP1:
-                package_fd.seek(1, os.SEEK_CUR)
-            elif block_type == StringInfoBlockTypes.SKIP2:
-                package_fd.seek(2, os.SEEK_CUR)
-            elif block_type == StringInfoBlockTypes.DUPLICATE:
-                package_fd.seek(2, os.SEEK_CUR)
-            elif block_type == StringInfoBlockTypes.EXT1:
-                package_fd.seek(1, os.SEEK_CUR)
-            elif block_type == StringInfoBlockTypes.EXT2:
-                package_fd.seek(2, os.SEEK_CUR)
-            elif block_type == StringInfoBlockTypes.EXT4:
-                package_fd.seek(4, os.SEEK_CUR)
-            else:
+        raw_type = None
+        while raw_type != end_type:
+            if offset >= len(blob):
+                raise HIIDBError('Insufficient data for next string info block')
+            start_offset = offset
+            raw_type = blob[offset]
+            offset += 1
+            skip = _STRING_BLOCK_SKIP[raw_type]
+            if skip:
+                offset += skip
+            elif raw_type == ucs2_type:
+                # The terminator must start on a character boundary
+                nul = blob.find(b'\x00\x00', offset)
+                while nul != -1 and (nul - offset) & 1:
+                    nul = blob.find(b'\x00\x00', nul + 1)
+                if nul == -1:
+                    raise HIIDBError('Unterminated UCS2 string')
+                offset = nul + 2
+            elif raw_type != end_type:
+                block_type = _STRING_BLOCK_TYPE_TABLE[raw_type]
+                if block_type is None:
+                    block_type = '0x{:02X}'.format(raw_type)
                 raise HIIDBError(
                     'Unsupported string info block type {}'.format(block_type)
                 )
-            package_items.append(
-                self._package_blob[start_offset:package_fd.tell()]
-            )
-        assert package_fd.tell() == len(self._package_blob)
+            package_items.append(blob[start_offset:offset])
+        if offset != len(blob):
+            raise HIIDBError('String package could not be parsed')
         self._package_items = tuple(package_items)
 
     def _parse_simple_fonts(self):
         # See section 32.3.2.1 -- EFI_HII_SIMPLE_FONT_PACKAGE_HDR
-        package_fd = io.BytesIO(self._package_blob)
-        package_fd.seek(4, os.SEEK_SET)
-        ng_count, wg_count = struct.unpack('=HH', package_fd.read(4))
-        narrow_glyphs = []
-        while ng_count > 0:
-            if (package_fd.tell() + 22) > len(self._package_blob):
-                raise HIIDBError('Insufficient data for next narrow glyph')
-            narrow_glyphs.append((
-                package_fd.read(2).decode('UTF-16'),
-                ord(package_fd.read(1)),
-                package_fd.read(19)
-            ))
-            ng_count -= 1
-        wide_glyphs = []
-        while wg_count > 0:
-            if (package_fd.tell() + 44) > len(self._package_blob):
-                raise HIIDBError('Insufficient data for next wide glyph')
-            wide_glyphs.append((
-                package_fd.read(2).decode('UTF-16'),
-                ord(package_fd.read(1)),
-                package_fd.read(19),
-                package_fd.read(19),
-            ))
-            package_fd.seek(3, os.SEEK_CUR)
-            wg_count -= 1
-        if package_fd.tell() != len(self._package_blob):
+        blob = self.blob
+        ng_count, wg_count = _HDR_SF.unpack_from(blob, 4)
+        offset = 8
+        if (offset + ng_count * NARROW_GLYPH.itemsize) > len(blob):
+            raise HIIDBError('Insufficient data for next narrow glyph')
+        narrow_glyphs = np.frombuffer(
+            blob, dtype=NARROW_GLYPH, count=ng_count, offset=offset
+        )
+        offset += ng_count * NARROW_GLYPH.itemsize
+        if (offset + wg_count * WIDE_GLYPH.itemsize) > len(blob):
+            raise HIIDBError('Insufficient data for next wide glyph')
+        wide_glyphs = np.frombuffer(
+            blob, dtype=WIDE_GLYPH, count=wg_count, offset=offset
+        )
+        offset += wg_count * WIDE_GLYPH.itemsize
+        if offset != len(blob):
             raise HIIDBError('Simple font package could not be parsed')
-        self._package_items = (tuple(narrow_glyphs), tuple(wide_glyphs))
+        self._package_items = (
+            GlyphTable(narrow_glyphs), GlyphTable(wide_glyphs)
+        )
 
     def _parse_forms(self):
         self._package_items = ()
@@ -209,13 +345,13 @@ class HIIPackage(object):
     @property
     def items(self):
         if self._package_items is None:
-            if self._package_type == HIIPackageTypes.STRINGS:
+            if self._raw_type == HIIPackageTypes.STRINGS:
                 self._parse_strings()
-            elif self._package_type == HIIPackageTypes.DEVICE_PATH:
+            elif self._raw_type == HIIPackageTypes.DEVICE_PATH:
                 self._parse_device_paths()
-            elif self._package_type == HIIPackageTypes.SIMPLE_FONTS:
+            elif self._raw_type == HIIPackageTypes.SIMPLE_FONTS:
                 self._parse_simple_fonts()
-            elif self._package_type == HIIPackageTypes.FORMS:
+            elif self._raw_type == HIIPackageTypes.FORMS:
                 self._parse_forms()
             else:
                 raise HIIDBError('Unsupported package type')
@@ -223,13 +359,18 @@ class HIIPackage(object):
 
 
 class HIIPackageList(object):
+    __slots__ = ('_base', '_offset', '_size', '_guid', '_packages')
 
-    def __init__(self, pl_blob: bytes):
+    def __init__(self, base: memoryview, offset: int, size: int):
         """
         Container and decoder for one HII package list.
-        :param pl_blob: The package list as a serialized data blob
+        :param base: The HII database the package list is stored in
+        :param offset: Offset of the package list header within base
+        :param size: Size of the package list, including its header
         """
-        self._pl_blob = pl_blob
+        self._base = base
+        self._offset = offset
+        self._size = size
         self._guid = None
         self._packages = None
 
@@ -239,9 +380,11 @@ class HIIPackageList(object):
         Return a string representation of the package list GUID.
         """
         if self._guid is None:
-            self._guid = '-'.join((
-                self._pl_blob[0:4].hex(), self._pl_blob[4:6].hex(),
-                self._pl_blob[6:8].hex(), self._pl_blob[8:16].hex()
+            time_low, time_mid, time_hi, node = EFI_GUID.unpack_from(
+                self._base, self._offset
+            )
+            self._guid = sys.intern('%08x-%04x-%04x-%s-%s' % (
+                time_low, time_mid, time_hi, node[:2].hex(), node[2:].hex()
             ))
         return self._guid
 
@@ -252,30 +395,60 @@ class HIIPackageList(object):
         """
         if self._packages is None:
             packages = []
-            pl_fd = io.BytesIO(self._pl_blob)
-            pl_fd.seek(20, io.SEEK_SET)  # 16 bytes GUID + 4 bytes length
-            while pl_fd.tell() < len(self._pl_blob):
-                start_offset = pl_fd.tell()
-                if (start_offset + 4) > len(self._pl_blob):
+            end_offset = self._offset + self._size
+            offset = self._offset + 20  # 16 bytes GUID + 4 bytes length
+            while offset < end_offset:
+                start_offset = offset
+                if (start_offset + 4) > end_offset:
                     raise HIIDBError('Insufficient data for next package header')
-                package_header, = struct.unpack('=L', pl_fd.read(4))
+                # The type is the high byte of the little-endian header
+                raw_type = self._base[start_offset + 3]
+                if raw_type == HIIPackageTypes.PACKAGE_END:
+                    offset += 4
+                    break
+                if _HII_TYPE_TABLE[raw_type] is None:
+                    raise HIIDBError(
+                        'Unsupported package type 0x{:02X}'.format(raw_type)
+                    )
+                package_header, = UINT32.unpack_from(self._base, offset)
                 package_size = package_header & 0xFFFFFF
-                if (start_offset + package_size) > len(self._pl_blob):
+                if package_size < 4:
+                    raise HIIDBError('Invalid package size')
+                if (start_offset + package_size) > end_offset:
                     raise HIIDBError('Insufficient data for next package')
-                package_type = HIIPackageTypes((package_header >> 24) & 0xFF)
-                if package_type == HIIPackageTypes.PACKAGE_END:
-                    break
-                pl_fd.seek(start_offset)
+                offset = start_offset + package_size
                 packages.append(HIIPackage(
-                    package_type, pl_fd.read(package_size)
+                    self._base, start_offset, package_size, raw_type
                 ))
-            if pl_fd.tell() != len(self._pl_blob):
+            if offset != end_offset:
                 raise HIIDBError('Package list encoding problem (corrupt data?)')
             self._packages = tuple(packages)
         return self._packages
 
+    @staticmethod
+    def _index(hii_mv: memoryview) -> list:
+        """
+        Locate every package list in the HII database.
+        :param hii_mv: The serialized HII database
+        :return: An (offset, size) pair for each package list
+        """
+        package_lists = []
+        offset = 0
+        while offset < len(hii_mv):
+            if (offset + 20) > len(hii_mv):
+                raise HIIDBError('Insufficient data for next package list header')
+            package_list_size, = UINT32.unpack_from(hii_mv, offset + 16)
+            if package_list_size < 20:
+                raise HIIDBError('Invalid package list size')
+            if (offset + package_list_size) > len(hii_mv):
+                raise HIIDBError('Insufficient data for next package list')
+            package_lists.append((offset, package_list_size))
+            offset += package_list_size
+        # The checks above guarantee the walk ends exactly on the last byte
+        return package_lists
+
     @classmethod
-    def scan(cls, hii_blob: Union[None, bytes]=None) -> Tuple:
+    def scan(cls, hii_blob: Union[None, bytes, memoryview]=None) -> Tuple:
         """
         Deserialize all package lists from the HII database.
         :param hii_blob: The serialized HII database
@@ -283,40 +456,36 @@ class HIIPackageList(object):
         """
         if hii_blob is None:
             hii_blob = read_hii_data()
-        package_lists = []
-        hii_blob_fd = io.BytesIO(hii_blob)
-        while hii_blob_fd.tell() < len(hii_blob):
-            start_offset = hii_blob_fd.tell()
-            if (start_offset + 20) > len(hii_blob):
-                raise HIIDBError('Insufficient data for next package list header')
-            hii_blob_fd.seek(16, os.SEEK_CUR)
-            package_list_size, = struct.unpack('=L', hii_blob_fd.read(4))
-            if (start_offset + package_list_size) > len(hii_blob):
-                raise HIIDBError('Insufficient data for next package list')
-            hii_blob_fd.seek(start_offset)
-            package_lists.append(cls(hii_blob_fd.read(package_list_size)))
-            start_offset += package_list_size
-        if hii_blob_fd.tell() != len(hii_blob):
-            raise HIIDBError('HII database encoding problem (corrupt data?)')
-        return tuple(package_lists)
+        hii_mv = memoryview(hii_blob)
+        return tuple(
+            cls(hii_mv, offset, size) for offset, size in cls._index(hii_mv)
+        )
 
 
 @click.command()
 @click.option('--dump-db', type=click.Path(), help='Dump the HII DB to a file.')
-def _main(dump_db):
+@click.option('--dump-first-package', type=click.Path(),
+              help='Also dump the first package to a file.')
+def _main(dump_db, dump_first_package):
+    if dump_first_package and not dump_db:
+        raise click.UsageError('--dump-first-package requires --dump-db')
     if dump_db:
         print('Writing HII database to ' + dump_db)
         try:
             hii_database = read_hii_data()
-            with open(dump_db, 'wb') as hii_fd:
-                hii_fd.write(hii_database)
+            _write_buffer(dump_db, hii_database)
             package_lists = HIIPackageList.scan(hii_database)
             for package_list in package_lists:
                 print(package_list.guid)
                 for package in package_list.packages:
                     print('  {}: {}'.format(package.package_type, len(package.items)))
-            with open('/tmp/PACKAGE', 'wb') as package_fd:
-                package_fd.write(package_lists[0].packages[0]._package_blob)
+            if dump_first_package:
+                if not package_lists or not package_lists[0].packages:
+                    raise HIIDBError('No package available to dump')
+                print('Writing first package to ' + dump_first_package)
+                _write_buffer(
+                    dump_first_package, package_lists[0].packages[0].blob
+                )
             return 0
         except HIIDBError as hii_err:
             print('ERROR: ' + str(hii_err))